@@ -3,18 +3,48 @@ Claude Code CLI executor (subprocess approach like richardatct).
 Executes the claude CLI command and parses stream-json output.
 """
 import asyncio
+import io
 import json
 import logging
 import uuid
-from collections import deque
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+try:
+    # orjson is several times faster than stdlib json on stream-json lines.
+    # It is a locked dependency; stdlib json covers installs without it.
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(line: bytes) -> Any:
+    # json.loads(bytes) raises on invalid UTF-8; mangle it instead,
+    # as the text stream this replaced did
+    return json.loads(line.decode("utf-8", "replace"))
+
+
+if orjson is not None:
+
+    def _loads(line: bytes) -> Any:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # orjson rejects what stdlib json accepts: escaped lone
+            # surrogates ("\ud800", e.g. a split emoji) and invalid UTF-8
+            return _json_loads(line)
+
+else:
+    _loads = _json_loads
 
 logger = logging.getLogger(__name__)
 
+# Claude CLI stderr when --resume names an unknown session
+_SESSION_NOT_FOUND = b"No conversation found"
+
 
-@dataclass
+@dataclass(slots=True)
 class StreamUpdate:
     """Enhanced streaming update from Claude CLI."""
     type: str  # 'assistant', 'user', 'system', 'result', 'tool_result', 'error', 'progress'
@@ -28,6 +58,11 @@ class StreamUpdate:
     error_info: Optional[Dict] = None
     execution_id: Optional[str] = None
 
+    # File edit preview fields (type 'file_edit')
+    file_path: Optional[str] = None
+    old_content: Optional[str] = None
+    new_content: Optional[str] = None
+
     def is_error(self) -> bool:
         """Check if this update represents an error."""
         return self.type == "error" or (
@@ -55,7 +90,7 @@ class StreamUpdate:
         return None
 
 
-@dataclass
+@dataclass(slots=True)
 class ClaudeResponse:
     """Response from Claude Code CLI."""
     content: str
@@ -68,6 +103,61 @@ class ClaudeResponse:
     tools_used: List[Dict[str, Any]] = field(default_factory=list)
 
 
+@dataclass(slots=True)
+class _StreamState:
+    """Totals accumulated while parsing one CLI run."""
+    turn_count: int = 0
+    session_id: str = ""
+    cost: float = 0.0
+    content: io.StringIO = field(default_factory=io.StringIO)
+    text_blocks: int = 0
+    tools: List[Dict[str, Any]] = field(default_factory=list)
+    parsing_errors: List[str] = field(default_factory=list)
+
+    def add_text(self, text: str) -> None:
+        """Append a text block, newline-separated from the previous one."""
+        if self.text_blocks:
+            self.content.write("\n")
+        self.content.write(text)
+        self.text_blocks += 1
+
+
+StreamCallback = Callable[[List[StreamUpdate]], Awaitable[None]]
+_MessageParser = Callable[[dict, _StreamState], List[StreamUpdate]]
+
+
+def per_update_callback(
+    callback: Callable[[StreamUpdate], Awaitable[None]]
+) -> StreamCallback:
+    """Adapt a single-update callback to the batched stream callback API."""
+
+    async def _batch_callback(updates: List[StreamUpdate]) -> None:
+        for update in updates:
+            await callback(update)
+
+    return _batch_callback
+
+
+class _LineReader:
+    """Line source for _stream_output whose reads may be timed out.
+
+    ``next_line()`` can be cancelled (e.g. by ``asyncio.wait_for``) without
+    losing data: ``StreamReader.readline()`` only consumes a complete line.
+    """
+
+    __slots__ = ("stream",)
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def next_line(self) -> Optional[bytes]:
+        """Return the next line without its newline, or None at EOF."""
+        line = await self.stream.readline()
+        if not line:
+            return None
+        return line.rstrip(b"\n")
+
+
 class ClaudeProcessManager:
     """Manage Claude Code subprocess execution (richardatct approach)."""
 
@@ -76,9 +166,30 @@ class ClaudeProcessManager:
         self.config = config
         self.active_processes: Dict[str, asyncio.subprocess.Process] = {}
 
-        # Memory optimization
-        self.max_message_buffer = 1000
-        self.streaming_buffer_size = 65536  # 64KB
+        # Settings are fixed for the process lifetime: read them once
+        self.timeout_seconds = config.claude_timeout_seconds
+        self.max_turns = config.claude_max_turns
+        self.allowed_tools = tuple(getattr(config, "claude_allowed_tools", None) or ())
+        self._argv_suffix = self._build_argv_suffix()
+
+        # Stream callback batching: deliver up to N updates per await, at
+        # least every interval seconds. Terminal/tool updates flush at once.
+        self.stream_batch_size = 8
+        self.stream_batch_interval = 0.05
+
+        # Subprocess pipes
+        self._stream_limit = 1024 * 1024 * 512  # 512MB memory limit
+        self.max_stderr_bytes = 1024 * 1024  # Keep the last 1MB of stderr
+        # The user sees only the end of it: one Telegram message at most
+        self.max_error_chars = 3000
+
+        # Stream message type -> parser (one dict lookup per message). Parsers
+        # also accumulate the run's totals into the _StreamState.
+        self._message_parsers: Dict[str, _MessageParser] = {
+            "assistant": self._parse_assistant_message,
+            "result": self._parse_result_message,
+            "tool_result": self._parse_tool_result,
+        }
 
     async def execute_command(
         self,
@@ -86,17 +197,23 @@ class ClaudeProcessManager:
         working_directory: Path,
         session_id: Optional[str] = None,
         continue_session: bool = False,
-        stream_callback: Optional[Callable[[StreamUpdate], None]] = None,
+        stream_callback: Optional[StreamCallback] = None,
     ) -> ClaudeResponse:
-        """Execute Claude Code CLI command."""
+        """Execute Claude Code CLI command.
+
+        ``stream_callback`` receives batches of updates; wrap single-update
+        callbacks with ``per_update_callback``.
+        """
         # Build command
         cmd = self._build_command(prompt, session_id, continue_session)
 
         # Create process ID
         process_id = str(uuid.uuid4())
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
 
         logger.info(
-            f"Starting Claude Code CLI process {process_id} in {working_directory}"
+            "Starting Claude Code CLI process %s in %s", process_id, working_directory
         )
 
         try:
@@ -107,12 +224,16 @@ class ClaudeProcessManager:
             # Handle output with timeout
             result = await asyncio.wait_for(
                 self._handle_process_output(process, stream_callback),
-                timeout=self.config.claude_timeout_seconds,
+                timeout=self.timeout_seconds,
             )
+            result.duration_ms = int((loop.time() - started_at) * 1000)
 
             logger.info(
-                f"Claude CLI completed successfully: cost=${result.cost:.4f}, "
-                f"duration={result.duration_ms}ms, tools={len(result.tools_used)}"
+                "Claude CLI completed successfully: "
+                "cost=$%.4f, duration=%sms, tools=%d",
+                result.cost,
+                result.duration_ms,
+                len(result.tools_used),
             )
 
             return result
@@ -123,15 +244,13 @@ class ClaudeProcessManager:
                 self.active_processes[process_id].kill()
                 await self.active_processes[process_id].wait()
 
-            logger.error(
-                f"Claude CLI timed out after {self.config.claude_timeout_seconds}s"
-            )
+            logger.error("Claude CLI timed out after %ss", self.timeout_seconds)
             raise TimeoutError(
-                f"Claude Code timed out after {self.config.claude_timeout_seconds}s"
+                f"Claude Code timed out after {self.timeout_seconds}s"
             )
 
         except Exception as e:
-            logger.error(f"Claude CLI process failed: {e}")
+            logger.error("Claude CLI process failed: %s", e)
             raise
 
         finally:
@@ -139,6 +258,31 @@ class ClaudeProcessManager:
             if process_id in self.active_processes:
                 del self.active_processes[process_id]
 
+    async def aclose(self) -> None:
+        """Kill any CLI processes still running (called on shutdown)."""
+        processes = list(self.active_processes.values())
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
+        await asyncio.gather(
+            *(process.wait() for process in processes), return_exceptions=True
+        )
+        self.active_processes.clear()
+
+    def _build_argv_suffix(self) -> List[str]:
+        """Build the CLI flags that are the same for every command."""
+        # Always use streaming JSON for real-time updates
+        suffix = ["--output-format", "stream-json", "--verbose"]
+
+        # Safety limits
+        suffix.extend(["--max-turns", str(self.max_turns)])
+
+        # Allowed tools
+        if self.allowed_tools:
+            suffix.extend(["--allowedTools", ",".join(self.allowed_tools)])
+
+        return suffix
+
     def _build_command(
         self, prompt: str, session_id: Optional[str], continue_session: bool
     ) -> List[str]:
@@ -160,193 +304,306 @@ class ClaudeProcessManager:
             # Fallback
             cmd.extend(["-p", ""])
 
-        # Always use streaming JSON for real-time updates
-        cmd.extend(["--output-format", "stream-json"])
-        cmd.extend(["--verbose"])
-
-        # Safety limits
-        cmd.extend(["--max-turns", str(self.config.claude_max_turns)])
+        # Prompt-independent flags are built once in _build_argv_suffix
+        cmd.extend(self._argv_suffix)
 
-        # Allowed tools
-        if hasattr(self.config, 'claude_allowed_tools') and self.config.claude_allowed_tools:
-            cmd.extend(["--allowedTools", ",".join(self.config.claude_allowed_tools)])
-
-        logger.debug(f"Built command: {' '.join(cmd)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Built command: %s", " ".join(cmd))
         return cmd
 
-    async def _start_process(self, cmd: List[str], cwd: Path) -> asyncio.subprocess.Process:
+    async def _start_process(
+        self, cmd: List[str], cwd: Path
+    ) -> asyncio.subprocess.Process:
         """Start Claude CLI subprocess."""
         return await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
             cwd=str(cwd),
-            limit=1024 * 1024 * 512,  # 512MB memory limit
+            limit=self._stream_limit,
         )
 
     async def _handle_process_output(
-        self, process: asyncio.subprocess.Process, stream_callback: Optional[Callable]
+        self,
+        process: asyncio.subprocess.Process,
+        stream_callback: Optional[StreamCallback],
     ) -> ClaudeResponse:
         """Parse stream-json output from Claude CLI."""
-        message_buffer = deque(maxlen=self.max_message_buffer)
-        result_data = None
-        parsing_errors = []
-
-        # Collect all content and tools
-        all_content = []
-        all_tools = []
-
-        async for line in self._read_stream_bounded(process.stdout):
-            try:
-                msg = json.loads(line)
+        # Drain stderr concurrently so a chatty CLI never blocks on a full pipe
+        stderr_task = asyncio.create_task(self._drain_stderr(process.stderr))
+        try:
+            return await self._collect_output(process, stream_callback, stderr_task)
+        finally:
+            if not stderr_task.done():
+                stderr_task.cancel()
 
-                # Validate message structure
-                if not isinstance(msg, dict) or "type" not in msg:
-                    parsing_errors.append(f"Invalid message: {line[:100]}")
-                    continue
+    async def _collect_output(
+        self,
+        process: asyncio.subprocess.Process,
+        stream_callback: Optional[StreamCallback],
+        stderr_task: "asyncio.Task[bytes]",
+    ) -> ClaudeResponse:
+        """Parse stdout into a ClaudeResponse once the process exits."""
+        state = _StreamState()
 
-                message_buffer.append(msg)
-
-                # Parse and send stream update
-                update = self._parse_stream_message(msg)
-                if update and stream_callback:
-                    try:
-                        await stream_callback(update)
-                    except Exception as e:
-                        logger.warning(f"Stream callback failed: {e}")
-
-                # Extract content from assistant messages (richardatct format: msg.message.content)
-                if msg.get("type") == "assistant":
-                    message = msg.get("message", {})
-                    content_blocks = message.get("content", [])
-                    for block in content_blocks:
-                        if isinstance(block, dict):
-                            if block.get("type") == "text":
-                                all_content.append(block.get("text", ""))
-                            elif block.get("type") == "tool_use":
-                                all_tools.append({
-                                    "name": block.get("name"),
-                                    "input": block.get("input", {}),
-                                    "id": block.get("id"),
-                                })
-
-                # Check for final result
-                if msg.get("type") == "result":
-                    result_data = msg
-
-            except json.JSONDecodeError as e:
-                parsing_errors.append(f"JSON decode error: {e}")
-                logger.warning(f"Failed to parse line: {line[:200]}")
-                continue
+        await self._stream_output(process.stdout, state, stream_callback)
 
         # Log parsing errors
-        if parsing_errors:
-            logger.warning(f"Encountered {len(parsing_errors)} parsing errors")
+        if state.parsing_errors:
+            logger.warning("Encountered %d parsing errors", len(state.parsing_errors))
 
         # Wait for process completion
         return_code = await process.wait()
+        stderr = await stderr_task
 
         if return_code != 0:
-            stderr = await process.stderr.read()
             error_msg = stderr.decode("utf-8", errors="replace")
-            logger.error(f"Claude CLI failed with code {return_code}: {error_msg}")
+            logger.error("Claude CLI failed with code %s: %s", return_code, error_msg)
+
+            # --resume of a session the CLI no longer has, as opposed to a
+            # transient failure (API error, overload, usage limit)
+            if _SESSION_NOT_FOUND in stderr:
+                error_type = "session_not_found"
+            else:
+                error_type = "process_error"
 
+            if len(error_msg) > self.max_error_chars:
+                error_msg = "..." + error_msg[-self.max_error_chars:]
             return ClaudeResponse(
                 content=f"Error: {error_msg}",
                 session_id="",
                 is_error=True,
-                error_type="process_error",
+                error_type=error_type,
             )
 
         # Extract final response
-        content_text = "\n".join(all_content) if all_content else "No response"
-        session_id = result_data.get("session_id", "") if result_data else ""
-        cost = result_data.get("total_cost_usd", 0.0) if result_data else 0.0
+        content_text = state.content.getvalue() if state.text_blocks else "No response"
 
         return ClaudeResponse(
             content=content_text,
-            session_id=session_id,
-            cost=cost,
-            duration_ms=0,  # Not tracked in this simple version
-            num_turns=len(message_buffer),
-            tools_used=all_tools,
+            session_id=state.session_id,
+            cost=state.cost,
+            num_turns=state.turn_count,
+            tools_used=state.tools,
         )
 
-    async def _read_stream_bounded(self, stream):
-        """Read stream line by line with memory bounds."""
-        buffer = b""
+    async def _stream_output(
+        self,
+        stream: asyncio.StreamReader,
+        state: _StreamState,
+        stream_callback: Optional[StreamCallback],
+    ) -> None:
+        """Parse the output as it arrives, batching stream updates.
+
+        Queued updates are delivered at most stream_batch_interval after the
+        first of them was queued, even while the CLI prints nothing (a long
+        tool run or a long think).
+        """
+        loop = asyncio.get_running_loop()
+        pending_updates: List[StreamUpdate] = []
+        deadline = 0.0  # Flush time of the current batch
+
+        lines = self._read_stream_bounded(stream)
         while True:
-            chunk = await stream.read(self.streaming_buffer_size)
-            if not chunk:
+            if pending_updates:
+                try:
+                    line = await asyncio.wait_for(
+                        lines.next_line(), max(0.0, deadline - loop.time())
+                    )
+                except asyncio.TimeoutError:
+                    await self._flush_updates(stream_callback, pending_updates)
+                    pending_updates = []
+                    continue
+            else:
+                line = await lines.next_line()
+            if line is None:
                 break
 
-            buffer += chunk
-
-            # Process complete lines
-            while b"\n" in buffer:
-                line, buffer = buffer.split(b"\n", 1)
-                yield line.decode("utf-8", errors="replace")
-
-    def _parse_stream_message(self, msg: dict) -> Optional[StreamUpdate]:
-        """Parse stream-json message into StreamUpdate (richardatct format)."""
-        msg_type = msg.get("type")
-
-        if msg_type == "assistant":
-            # Extract tool calls - format is msg.message.content
-            message = msg.get("message", {})
-            content_blocks = message.get("content", [])
-
-            tool_calls = []
-            text_parts = []
-
-            for block in content_blocks:
-                if isinstance(block, dict):
-                    if block.get("type") == "tool_use":
-                        tool_calls.append({
-                            "name": block.get("name"),
-                            "input": block.get("input", {}),
-                            "id": block.get("id"),
-                        })
-                    elif block.get("type") == "text":
-                        text_parts.append(block.get("text", ""))
-
-            if tool_calls:
-                return StreamUpdate(
+            updates = self._process_line(line, state)
+            if updates and stream_callback:
+                if not pending_updates:
+                    deadline = loop.time() + self.stream_batch_interval
+                pending_updates.extend(updates)
+                if (
+                    any(update.type in ("tool_use", "result") for update in updates)
+                    or len(pending_updates) >= self.stream_batch_size
+                    or loop.time() >= deadline
+                ):
+                    await self._flush_updates(stream_callback, pending_updates)
+                    pending_updates = []
+
+        # Deliver whatever is still queued
+        if pending_updates:
+            await self._flush_updates(stream_callback, pending_updates)
+
+    def _process_line(self, line: bytes, state: _StreamState) -> List[StreamUpdate]:
+        """Parse one stream-json line, accumulate it into state, return its updates."""
+        try:
+            msg = _loads(line)
+        except ValueError as e:  # json.JSONDecodeError
+            state.parsing_errors.append(f"JSON decode error: {e}")
+            logger.warning(
+                "Failed to parse line: %s", line[:200].decode("utf-8", "replace")
+            )
+            return []
+
+        # Validate message structure
+        if not isinstance(msg, dict) or "type" not in msg:
+            state.parsing_errors.append(
+                f"Invalid message: {line[:100].decode('utf-8', 'replace')}"
+            )
+            return []
+
+        state.turn_count += 1
+        return self._parse_stream_message(msg, state)
+
+    async def _flush_updates(
+        self, stream_callback: StreamCallback, updates: List[StreamUpdate]
+    ) -> None:
+        """Send a batch of stream updates to the callback."""
+        try:
+            await stream_callback(updates)
+        except Exception as e:
+            logger.warning("Stream callback failed: %s", e)
+
+    async def _drain_stderr(self, stream: asyncio.StreamReader) -> bytes:
+        """Read stderr to EOF, keeping only the last max_stderr_bytes."""
+        tail = bytearray()
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            tail.extend(chunk)
+            if len(tail) > self.max_stderr_bytes:
+                del tail[:-self.max_stderr_bytes]
+        return bytes(tail)
+
+    def _read_stream_bounded(self, stream) -> "_LineReader":
+        """Read stream line by line with memory bounds.
+
+        Framing is delegated to ``StreamReader.readline()``; the
+        per-line bound is the stream limit set in ``_start_process``. Lines
+        are raw bytes; the JSON parser decodes UTF-8 itself.
+        """
+        return _LineReader(stream)
+
+    def _parse_stream_message(
+        self, msg: dict, state: _StreamState
+    ) -> List[StreamUpdate]:
+        """Parse stream-json message into StreamUpdates (richardatct format)."""
+        handler = self._message_parsers.get(msg.get("type"))
+        return handler(msg, state) if handler else []
+
+    def _parse_assistant_message(
+        self, msg: dict, state: _StreamState
+    ) -> List[StreamUpdate]:
+        """Parse an assistant message in a single pass over its content.
+
+        The text parts and tool calls (richardatct format: msg.message.content)
+        feed both the updates and the run's totals. File-changing tool calls
+        add a ``file_edit`` update each, for the diff preview.
+        """
+        message = msg.get("message", {})
+        content_blocks = message.get("content", [])
+
+        tool_calls = []
+        text_parts = []
+
+        for block in content_blocks:
+            if isinstance(block, dict):
+                if block.get("type") == "tool_use":
+                    tool_calls.append({
+                        "name": block.get("name"),
+                        "input": block.get("input", {}),
+                        "id": block.get("id"),
+                    })
+                elif block.get("type") == "text":
+                    text_parts.append(block.get("text", ""))
+
+        for text in text_parts:
+            state.add_text(text)
+        state.tools.extend(tool_calls)
+
+        if tool_calls:
+            updates = [
+                StreamUpdate(
                     type="tool_use",
                     content="🔧 " + ", ".join([t["name"] for t in tool_calls]),
                     tool_calls=tool_calls,
                 )
-            elif text_parts:
-                return StreamUpdate(
-                    type="assistant",
-                    content="\n".join(text_parts),
-                )
-
-        elif msg_type == "tool_result":
-            result = msg.get("result", {})
-            is_error = result.get("is_error", False) if isinstance(result, dict) else False
-
-            if is_error:
-                return StreamUpdate(
-                    type="tool_result",
-                    content="❌ Tool failed",
-                    metadata=msg,
-                )
-            else:
-                return StreamUpdate(
-                    type="tool_result",
-                    content="✅ Tool completed",
-                    metadata=msg,
-                )
+            ]
+            for call in tool_calls:
+                updates.extend(self._file_edit_updates(call))
+            return updates
+        if text_parts:
+            return [StreamUpdate(type="assistant", content="\n".join(text_parts))]
+        return []
+
+    def _file_edit_updates(self, call: Dict[str, Any]) -> List[StreamUpdate]:
+        """Build the file_edit updates for an Edit, MultiEdit or Write call."""
+        tool_input = call["input"]
+        if not isinstance(tool_input, dict) or not tool_input.get("file_path"):
+            return []
+        file_path = tool_input["file_path"]
+
+        name = call["name"]
+        if name == "Edit":
+            edits = [tool_input]
+        elif name == "MultiEdit":
+            edits = tool_input.get("edits") or []
+        elif name == "Write":
+            # The previous content is not part of the call: show it all as added
+            edits = [{"old_string": "", "new_string": tool_input.get("content")}]
+        else:
+            return []
 
-        elif msg_type == "result":
-            return StreamUpdate(
+        return [
+            StreamUpdate(
+                type="file_edit",
+                file_path=file_path,
+                old_content=edit.get("old_string") or "",
+                new_content=edit.get("new_string") or "",
+            )
+            for edit in edits
+            if isinstance(edit, dict)
+        ]
+
+    def _parse_result_message(
+        self, msg: dict, state: _StreamState
+    ) -> List[StreamUpdate]:
+        """Parse the final result message, recording its session ID and cost."""
+        state.session_id = msg.get("session_id", "")
+        state.cost = msg.get("total_cost_usd", 0.0)
+        return [
+            StreamUpdate(
                 type="result",
                 content="✅ Execution completed",
                 metadata={
-                    "cost": msg.get("total_cost_usd", 0.0),
-                    "session_id": msg.get("session_id", ""),
+                    "cost": state.cost,
+                    "session_id": state.session_id,
                 },
             )
-
-        return None
+        ]
+
+    def _parse_tool_result(
+        self, msg: dict, state: _StreamState
+    ) -> List[StreamUpdate]:
+        """Parse a tool_result message into a StreamUpdate."""
+        result = msg.get("result", {})
+        is_error = result.get("is_error", False) if isinstance(result, dict) else False
+
+        if is_error:
+            return [
+                StreamUpdate(
+                    type="tool_result",
+                    content="❌ Tool failed",
+                    metadata=msg,
+                )
+            ]
+        return [
+            StreamUpdate(
+                type="tool_result",
+                content="✅ Tool completed",
+                metadata=msg,
+            )
+        ]
@@ -4,7 +4,7 @@ Loads environment variables and validates configuration.
 """
 import os
 from pathlib import Path
-from typing import List
+from typing import Final, Tuple
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
@@ -18,15 +18,15 @@ class Settings(BaseSettings):
 
     # Security
     approved_directory: Path = Field(..., env="APPROVED_DIRECTORY")
-    allowed_users: List[int] = Field(..., env="ALLOWED_USERS")
+    allowed_users: Tuple[int, ...] = Field(..., env="ALLOWED_USERS")
 
     # Claude Configuration
     use_sdk: bool = Field(False, env="USE_SDK")
     claude_max_turns: int = Field(10, env="CLAUDE_MAX_TURNS")
     claude_max_cost_per_user: float = Field(10.0, env="CLAUDE_MAX_COST_PER_USER")
     claude_timeout_seconds: int = Field(900, env="CLAUDE_TIMEOUT_SECONDS")
-    claude_allowed_tools: List[str] = Field(
-        default=[
+    claude_allowed_tools: Tuple[str, ...] = Field(
+        default=(
             "Read",
             "Write",
             "Edit",
@@ -40,13 +40,14 @@ class Settings(BaseSettings):
             "Skill",
             "SlashCommand",
             "AskUserQuestion",
-        ],
+        ),
         env="CLAUDE_ALLOWED_TOOLS",
     )
 
     # Rate Limiting
     rate_limit_requests: int = Field(10, env="RATE_LIMIT_REQUESTS")
     rate_limit_window: int = Field(60, env="RATE_LIMIT_WINDOW")
+    stream_edit_interval: float = Field(1.5, env="STREAM_EDIT_INTERVAL")
 
     # Features
     enable_file_uploads: bool = Field(True, env="ENABLE_FILE_UPLOADS")
@@ -57,12 +58,14 @@ class Settings(BaseSettings):
 
     # Database
     database_url: str = Field("sqlite:///telegram_bot.db", env="DATABASE_URL")
+    session_store_path: str = Field("data/sessions.pickle", env="SESSION_STORE_PATH")
 
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
         case_sensitive = False
+        frozen = True
 
 
 # Global settings instance
-settings = Settings()
+settings: Final[Settings] = Settings()
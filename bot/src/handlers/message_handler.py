@@ -1,193 +1,461 @@
 """Telegram message handlers."""
 import asyncio
-import io
+import contextlib
+import functools
+import hashlib
 import logging
-from telegram import Update
+from collections import OrderedDict, defaultdict
+from types import MappingProxyType
+from typing import Iterable, Iterator, List, Tuple
+
+from telegram import MessageEntity, Update
 from telegram.ext import ContextTypes
-from telegram.constants import ChatAction
+from telegram.constants import ChatAction, ParseMode
+from telegram.error import RetryAfter, TimedOut
 
 from src.claude.cli_executor import ClaudeProcessManager, StreamUpdate
 from src.security.validator import security_validator
 from src.config.settings import settings
+from src.utils.rate_limiter import AsyncTokenBucket
 
 logger = logging.getLogger(__name__)
 
-# Global executor (using CLI subprocess like richardatct)
-claude_executor = ClaudeProcessManager(settings)
 
-# Note: No confirmation system - Claude executes actions directly (like richardatct)
+@functools.lru_cache(maxsize=1)
+def _executor() -> ClaudeProcessManager:
+    """Shared executor (using CLI subprocess like richardatct), built on first use."""
+    return ClaudeProcessManager(settings)
 
 
-async def _send_typing_periodically(context: ContextTypes.DEFAULT_TYPE, update: Update):
-    """Send typing indicator every 4 seconds to show bot is working."""
+# Note: No confirmation system - Claude executes actions directly (like richardatct)
+
+# Outgoing Telegram API budget: ~1 msg/s per chat and ~30 msg/s per bot.
+# Keep some headroom below the global limit across concurrent sessions.
+_GLOBAL_BUCKET = AsyncTokenBucket(rate=25, capacity=25)
+_chat_buckets = defaultdict(lambda: AsyncTokenBucket(rate=1, capacity=1))
+
+# Shared send kwargs for Markdown-formatted messages
+_MD = MappingProxyType({"parse_mode": ParseMode.MARKDOWN})
+
+# Telegram message size limit (characters)
+MAX_MESSAGE_LENGTH = 4096
+
+
+def _bold_entities(markup: str) -> Tuple[str, Tuple[MessageEntity, ...]]:
+    """Split ``**bold**`` markup into plain text and prebuilt bold entities."""
+    parts = markup.split("**")
+    entities = []
+    offset = 0
+    for i, part in enumerate(parts):
+        # Entity offsets and lengths count UTF-16 code units
+        length = len(part.encode("utf-16-le")) // 2
+        if i % 2 and length:
+            entities.append(MessageEntity(MessageEntity.BOLD, offset, length))
+        offset += length
+    return "".join(parts), tuple(entities)
+
+
+# Static reply texts and progress templates
+# The welcome text is sent with prebuilt entities, so /start needs no
+# Markdown parsing
+_WELCOME_MSG, _WELCOME_ENTITIES = _bold_entities(
+    "🤖 **Claude Code Bot**\n\n"
+    "I have access to the full Claude Code CLI.\n\n"
+    "**Available tools:**\n"
+    "📖 Read, ✍️ Write, ✏️ Edit\n"
+    "🔧 Bash, 🔍 Glob, 🔎 Grep\n"
+    "🌐 WebSearch, 📋 TodoWrite\n"
+    "🎯 Task, ⚡ Skill, 🔨 SlashCommand\n\n"
+    "Just send me a message!"
+)
+_TOOL_FMT = "🔧 **{}**".format
+_ASSISTANT_FMT = "🤖 **Working...**\n\n_{}_".format
+_COMPLETED = "✅ **Completed!**"
+_PREVIEW_LENGTH = 150
+# Hard ceiling for any progress edit (long tool names/inputs included)
+_MAX_PROGRESS_LENGTH = 512
+# Content kept once the template (with its closing markup) and "..." fit
+_TOOL_CONTENT_LENGTH = _MAX_PROGRESS_LENGTH - len(_TOOL_FMT("..."))
+
+# Typing lasts 5s; renew it every 4s while Claude is streaming
+_TYPING_INTERVAL = 4.0
+
+# Strong references to fire-and-forget tasks until they finish
+_background_tasks = set()
+
+# Rendered diff PNGs by content hash: repeated edits (retries, edit loops)
+# are sent again without re-rendering.
+_DIFF_CACHE_SIZE = 32
+_diff_cache: "OrderedDict[bytes, bytes]" = OrderedDict()
+
+
+@functools.lru_cache(maxsize=1)
+def _diff_image():
+    """Import the Pillow-based diff renderer on the first file edit."""
+    from src.utils import diff_image
+    return diff_image
+
+
+def shutdown_diff_pool():
+    """Stop the diff rendering workers (called on application shutdown)."""
+    if _diff_image.cache_info().currsize:
+        _diff_image().shutdown_pool()
+
+
+async def close_executor():
+    """Stop running CLI processes and drop the shared executor (on shutdown)."""
+    if _executor.cache_info().currsize:
+        await _executor().aclose()
+        _executor.cache_clear()
+
+
+async def _send_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """Send one typing indicator (shows "..." animation for ~5s in Telegram).
+
+    Typing is best-effort: it is skipped rather than queued when the
+    bot-wide send budget is used up.
+    """
+    if not _GLOBAL_BUCKET.try_acquire():
+        return
     try:
-        while True:
-            await context.bot.send_chat_action(
-                chat_id=update.effective_chat.id,
-                action=ChatAction.TYPING
-            )
-            await asyncio.sleep(4)  # Typing lasts 5s, renew every 4s
-    except asyncio.CancelledError:
-        # Task was cancelled, stop gracefully
-        pass
+        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
     except Exception as e:
-        logger.debug(f"Typing indicator error: {e}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Typing indicator error: %s", e)
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command."""
     user_id = update.effective_user.id
 
-    if not security_validator.is_authorized(user_id):
-        await update.message.reply_text("⛔ Unauthorized access.")
+    if error := security_validator.precheck(user_id):
+        await update.message.reply_text(error)
         return
 
-    welcome_msg = (
-        "🤖 **Claude Code Bot**\n\n"
-        "I have access to the full Claude Code CLI.\n\n"
-        "**Available tools:**\n"
-        "📖 Read, ✍️ Write, ✏️ Edit\n"
-        "🔧 Bash, 🔍 Glob, 🔎 Grep\n"
-        "🌐 WebSearch, 📋 TodoWrite\n"
-        "🎯 Task, ⚡ Skill, 🔨 SlashCommand\n\n"
-        "Just send me a message!"
+    await _tg_send(
+        _chat_buckets[update.effective_chat.id],
+        update.message.reply_text,
+        _WELCOME_MSG,
+        entities=_WELCOME_ENTITIES,
     )
-    await update.message.reply_text(welcome_msg, parse_mode="Markdown")
 
 
 # Note: Removed detect_action_in_response - Claude executes actions directly now
 
 
+async def _acquire_send_budget(chat_bucket):
+    """Wait until both the chat and the bot-wide send budgets allow a call."""
+    await chat_bucket.acquire()
+    await _GLOBAL_BUCKET.acquire()
+
+
+async def _tg_send(chat_bucket, send, *args, **kwargs):
+    """Call a Telegram send/edit method once the send budget allows it.
+
+    On flood control the chat is held back for the requested time and the
+    call is retried once; a second RetryAfter propagates.
+    """
+    await _acquire_send_budget(chat_bucket)
+    try:
+        return await send(*args, **kwargs)
+    except RetryAfter as e:
+        logger.warning("Telegram flood control, retry after %ss", e.retry_after)
+        chat_bucket.defer(e.retry_after)
+        await _acquire_send_budget(chat_bucket)
+        return await send(*args, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def _background_task(coro):
+    """Run coro as a task for the duration of the block, then cancel it."""
+    task = asyncio.create_task(coro)
+    try:
+        yield task
+    finally:
+        task.cancel()
+        # Waits for the task to finish; an outer cancellation still propagates
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def _cancel_tasks(tasks):
+    """Cancel tasks and wait until they have stopped."""
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _flush_progress(thinking_msg, chat_bucket, latest_text, dirty):
+    """Edit the progress message to the latest text, at most once per interval."""
+    interval = settings.stream_edit_interval
+    while True:
+        await dirty.wait()
+        await _acquire_send_budget(chat_bucket)
+        dirty.clear()
+        try:
+            await thinking_msg.edit_text(latest_text[0], **_MD)
+        except RetryAfter as e:
+            # Hold every send to this chat (the final response included)
+            # until Telegram's flood-control window has passed, then show
+            # the latest text even if no further update arrives
+            chat_bucket.defer(e.retry_after)
+            dirty.set()
+        except Exception as e:
+            # Progress edits are best-effort
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Failed to update progress: %s", e)
+        await asyncio.sleep(interval)
+
+
+async def _send_diff(update: Update, chat_bucket, file_edit, previous):
+    """Render and send one diff preview, after the previous one was sent."""
+    try:
+        # Generate diff image (cached, rendered in the worker pool)
+        diff_image_bytes = await _render_diff(
+            file_edit.old_content, file_edit.new_content, file_edit.file_path
+        )
+        # Keep previews in edit order even if a later one rendered first
+        if previous is not None:
+            await previous
+
+        # Send diff image once the chat has budget
+        await _tg_send(
+            chat_bucket,
+            update.message.reply_photo,
+            photo=diff_image_bytes,
+            caption=f"📝 Proposed changes to `{file_edit.file_path}`",
+            **_MD,
+        )
+        logger.info("Sent diff image for %s", file_edit.file_path)
+    except Exception as e:
+        logger.error("Failed to send diff image: %s", e)
+
+
+def _clip(text: str, length: int) -> str:
+    """Keep the first ``length`` characters of text, marking a cut with "..."."""
+    return text[:length] + "..." if len(text) > length else text
+
+
+def _make_stream_callback(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_bucket,
+    latest_text,
+    dirty,
+    diff_sends,
+):
+    """Build the stream callback that feeds progress for one message.
+
+    Nothing here waits on Telegram: progress text goes to the flusher and
+    diff previews are sent by tasks appended to ``diff_sends``.
+    """
+    loop = asyncio.get_running_loop()
+    last_typing = 0.0
+
+    async def stream_callback(updates: List[StreamUpdate]):
+        """Update progress message with a batch of streaming updates."""
+        nonlocal last_typing
+
+        # Keep the typing indicator alive while updates are arriving
+        current_time = loop.time()
+        if current_time - last_typing >= _TYPING_INTERVAL:
+            last_typing = current_time
+            task = asyncio.create_task(_send_typing(context, update.effective_chat.id))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+
+        # Only the freshest progress update of a batch is worth showing
+        update_obj = None
+        for batch_update in updates:
+            # Handle file edit diff preview (never skipped)
+            if batch_update.type == "file_edit":
+                previous = diff_sends[-1] if diff_sends else None
+                task = asyncio.create_task(
+                    _send_diff(update, chat_bucket, batch_update, previous)
+                )
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+                diff_sends.append(task)
+            elif batch_update.type in ("tool_use", "assistant", "result"):
+                update_obj = batch_update
+
+        if update_obj is None:
+            return
+
+        # Format the progress message
+        progress_text = ""
+        if update_obj.type == "tool_use":
+            # Show tools being used
+            progress_text = _TOOL_FMT(_clip(update_obj.content, _TOOL_CONTENT_LENGTH))
+        elif update_obj.type == "assistant":
+            # Show Claude's thinking/response preview
+            progress_text = _ASSISTANT_FMT(_clip(update_obj.content, _PREVIEW_LENGTH))
+        elif update_obj.type == "result":
+            # Execution completed
+            progress_text = _COMPLETED
+
+        # Unchanged text needs no edit at all
+        if progress_text and progress_text != latest_text[0]:
+            # Hand off to the flusher; never wait on Telegram here
+            latest_text[0] = progress_text
+            dirty.set()
+
+    return stream_callback
+
+
+def _split_tg(text: str, size: int = MAX_MESSAGE_LENGTH) -> Iterator[str]:
+    """Yield Telegram-sized chunks of text, preferring to cut at a newline."""
+    start, end = 0, len(text)
+    while start < end:
+        stop = min(start + size, end)
+        if stop < end:
+            # Cut after the newline so the next chunk starts on a fresh line
+            newline = text.rfind("\n", start, stop)
+            if newline > start:
+                stop = newline + 1
+        yield text[start:stop]
+        start = stop
+
+
+async def _send_chunks(message, chunks: Iterable[str], chat_bucket):
+    """Reply with each chunk as its own message, one at a time."""
+    for chunk in chunks:
+        # Pace bursts of chunks so long responses don't trigger 429s
+        await _tg_send(chat_bucket, message.reply_text, chunk)
+
+
+def _diff_cache_key(old_content: str, new_content: str, file_path: str) -> bytes:
+    """Hash an edit's contents into a compact cache key."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (old_content or "", new_content or "", file_path or ""):
+        data = part.encode("utf-8", "surrogatepass")
+        # Length prefix keeps part boundaries unambiguous
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.digest()
+
+
+async def _render_diff(old_content: str, new_content: str, file_path: str) -> bytes:
+    """Return the diff PNG for an edit, rendering it in the pool on a cache miss."""
+    key = _diff_cache_key(old_content, new_content, file_path)
+    image = _diff_cache.get(key)
+    if image is not None:
+        _diff_cache.move_to_end(key)
+        return image
+
+    image = await _diff_image().generate_diff_image_async(
+        old_content, new_content, file_path
+    )
+    _diff_cache[key] = image
+    if len(_diff_cache) > _DIFF_CACHE_SIZE:
+        _diff_cache.popitem(last=False)
+    return image
+
+
+async def _reply_safely(message, text: str):
+    """Best-effort reply from an error path; a failure here is only logged."""
+    try:
+        await message.reply_text(text)
+    except Exception as e:
+        logger.warning("Failed to send error reply: %s", e)
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle user messages."""
     user_id = update.effective_user.id
     message_text = update.message.text
 
-    # Security checks
-    if not security_validator.is_authorized(user_id):
-        await update.message.reply_text("⛔ Unauthorized access.")
-        return
-
-    if not security_validator.check_rate_limit(user_id):
-        await update.message.reply_text("⏱️ Rate limit exceeded. Please wait.")
+    # Security checks (authorization, then rate limit)
+    if error := security_validator.precheck(user_id):
+        await update.message.reply_text(error)
         return
 
     # Budget check removed (CLI doesn't have built-in budget tracking)
 
     try:
-        # Start typing indicator (shows "..." animation in Telegram)
-        typing_task = asyncio.create_task(_send_typing_periodically(context, update))
+        chat_bucket = _chat_buckets[update.effective_chat.id]
 
         # Send "thinking" message
-        thinking_msg = await update.message.reply_text("🤔 Processing...")
+        thinking_msg = await _tg_send(
+            chat_bucket, update.message.reply_text, "🤔 Processing..."
+        )
 
-        # Initialize last_update_time for THIS message (must be inside try block)
-        last_update_time = 0  # Start at 0 to allow immediate first update
+        # Latest progress text; the flusher only ever shows the freshest one
+        latest_text = [""]
+        dirty = asyncio.Event()
+        # Diff preview sends, chained so they go out in order
+        diff_sends = []
 
         # Streaming callback to show real-time progress
-        async def stream_callback(update_obj: StreamUpdate):
-            """Update progress message with streaming updates."""
-            nonlocal last_update_time
-            current_time = asyncio.get_event_loop().time()
-
-            # Handle file edit diff preview (not throttled)
-            if update_obj.type == "file_edit":
-                try:
-                    # Generate diff image
-                    diff_image_bytes = generate_diff_image(
-                        update_obj.old_content,
-                        update_obj.new_content,
-                        update_obj.file_path
-                    )
-
-                    # Send diff image
-                    await update.message.reply_photo(
-                        photo=io.BytesIO(diff_image_bytes),
-                        caption=f"📝 Proposed changes to `{update_obj.file_path}`",
-                        parse_mode="Markdown"
-                    )
-                    logger.info(f"Sent diff image for {update_obj.file_path}")
-                except Exception as e:
-                    logger.error(f"Failed to send diff image: {e}")
-                return
-
-            # Throttle updates to max 1 per second to avoid Telegram rate limits
-            if current_time - last_update_time < 1.0:
-                return
-
-            last_update_time = current_time
-
-            # Format the progress message
-            progress_text = ""
-            if update_obj.type == "tool_use":
-                # Show tools being used
-                progress_text = f"🔧 **{update_obj.content}**"
-            elif update_obj.type == "assistant":
-                # Show Claude's thinking/response preview
-                content_preview = (
-                    update_obj.content[:150] + "..."
-                    if len(update_obj.content) > 150
-                    else update_obj.content
-                )
-                progress_text = f"🤖 **Working...**\n\n_{content_preview}_"
-            elif update_obj.type == "result":
-                # Execution completed
-                progress_text = "✅ **Completed!**"
-
-            if progress_text:
-                try:
-                    await thinking_msg.edit_text(progress_text, parse_mode="Markdown")
-                except Exception as e:
-                    # Ignore rate limit errors on streaming updates
-                    logger.debug(f"Failed to update progress: {e}")
+        stream_callback = _make_stream_callback(
+            update, context, chat_bucket, latest_text, dirty, diff_sends
+        )
 
         # Get current session ID (if any)
         session_id = context.user_data.get('claude_session_id')
 
-        # Execute Claude CLI with streaming (subprocess approach)
-        response_obj = await claude_executor.execute_command(
-            prompt=message_text,
-            working_directory=claude_executor.config.approved_directory,
-            session_id=session_id,
-            continue_session=bool(session_id),
-            stream_callback=stream_callback
-        )
+        # Execute Claude CLI with streaming (subprocess approach). Progress
+        # edits stop as soon as it returns or fails, before the final response.
+        executor = _executor()
+        async with _background_task(
+            _flush_progress(thinking_msg, chat_bucket, latest_text, dirty)
+        ):
+            try:
+                response_obj = await executor.execute_command(
+                    prompt=message_text,
+                    working_directory=executor.config.approved_directory,
+                    session_id=session_id,
+                    continue_session=bool(session_id),
+                    stream_callback=stream_callback
+                )
+                # Diff previews belong before the final response
+                if diff_sends and not response_obj.is_error:
+                    await diff_sends[-1]
+            finally:
+                # Previews of a failed or timed-out run must not follow
+                # its error reply; after a success they are all done
+                await _cancel_tasks(diff_sends)
 
         # Store session ID for next message
         if response_obj.session_id:
             context.user_data['claude_session_id'] = response_obj.session_id
+        elif response_obj.error_type == "session_not_found":
+            # A session that fails to resume (e.g. the CLI dropped its
+            # transcript) would fail every later message: start a new one.
+            # Other errors keep it, so a transient failure loses nothing.
+            context.user_data.pop('claude_session_id', None)
 
         # Get response text
         response = response_obj.content
 
-        # Stop typing indicator
-        typing_task.cancel()
-        try:
-            await typing_task
-        except asyncio.CancelledError:
-            pass
-
-        # Send response (split if too long) - no confirmation needed
-        if len(response) > 4096:
-            chunks = [response[i:i+4096] for i in range(0, len(response), 4096)]
-            await thinking_msg.delete()
-            for chunk in chunks:
-                await update.message.reply_text(chunk)
-        else:
-            await thinking_msg.edit_text(response)
+        # Send response (split if too long) - no confirmation needed. The
+        # first chunk reuses the thinking message; the rest follow as replies.
+        chunks = _split_tg(response)
+        await _tg_send(chat_bucket, thinking_msg.edit_text, next(chunks, response))
+        await _send_chunks(update.message, chunks, chat_bucket)
 
     except TimeoutError:
-        # Stop typing on timeout
-        if 'typing_task' in locals():
-            typing_task.cancel()
-        await update.message.reply_text(
-            "⏱️ Request timed out. Please try a simpler request."
+        # The Claude CLI run exceeded claude_timeout_seconds
+        await _reply_safely(
+            update.message, "⏱️ Request timed out. Please try a simpler request."
         )
-    except Exception as e:
-        logger.error(f"Error handling message: {e}")
-        await update.message.reply_text(
-            f"❌ Error: {str(e)[:200]}"
+    except TimedOut as e:
+        # Telegram did not answer in time; the send may still have gone out
+        logger.warning("Telegram request timed out: %s", e)
+        await _reply_safely(
+            update.message,
+            "⚠️ Telegram timed out; the reply above may be incomplete.",
         )
+    except RetryAfter as e:
+        # Still throttled after _tg_send's retry; wait it out before the note
+        logger.warning("Telegram flood control, retry after %ss", e.retry_after)
+        await asyncio.sleep(e.retry_after + 0.1)
+        await _reply_safely(
+            update.message,
+            "⚠️ Throttled by Telegram; the reply above may be incomplete.",
+        )
+    except Exception as e:
+        logger.error("Error handling message: %s", e)
+        await _reply_safely(update.message, f"❌ Error: {str(e)[:200]}")
 
 
 # Note: handle_callback_query removed - no confirmation system needed (matches richardatct)
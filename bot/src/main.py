@@ -3,10 +3,24 @@ Main entry point for the Telegram bot.
 """
 import logging
 import sys
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from pathlib import Path
+
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    MessageHandler,
+    PersistenceInput,
+    PicklePersistence,
+    filters,
+)
 
 from src.config.settings import settings
-from src.handlers.message_handler import start_command, handle_message
+from src.handlers.message_handler import (
+    start_command,
+    handle_message,
+    close_executor,
+    shutdown_diff_pool,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -16,15 +30,40 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def post_shutdown(application: Application):
+    """Release handler resources once the bot has stopped."""
+    await close_executor()
+    shutdown_diff_pool()
+
+
+def build_persistence(path: str) -> PicklePersistence:
+    """Persist user_data (Claude session IDs) so conversations survive restarts."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    return PicklePersistence(
+        filepath=path,
+        store_data=PersistenceInput(
+            bot_data=False, chat_data=False, user_data=True, callback_data=False
+        ),
+        update_interval=30,
+    )
+
+
 def main():
     """Start the bot."""
     logger.info("Starting Telegram Bot...")
-    logger.info(f"Approved directory: {settings.approved_directory}")
-    logger.info(f"Allowed users: {settings.allowed_users}")
-    logger.info(f"Allowed tools: {settings.claude_allowed_tools}")
+    logger.info("Approved directory: %s", settings.approved_directory)
+    logger.info("Allowed users: %s", settings.allowed_users)
+    logger.info("Allowed tools: %s", settings.claude_allowed_tools)
 
     # Create application
-    application = Application.builder().token(settings.telegram_bot_token).build()
+    builder = (
+        Application.builder()
+        .token(settings.telegram_bot_token)
+        .post_shutdown(post_shutdown)
+    )
+    if settings.session_store_path:
+        builder = builder.persistence(build_persistence(settings.session_store_path))
+    application = builder.build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -44,5 +83,5 @@ if __name__ == "__main__":
         logger.info("Bot stopped by user")
         sys.exit(0)
     except Exception as e:
-        logger.error(f"Fatal error: {e}", exc_info=True)
+        logger.error("Fatal error: %s", e, exc_info=True)
         sys.exit(1)
@@ -1,45 +1,55 @@
 """Security validation for user access and rate limiting."""
 import logging
 import time
-from collections import defaultdict, deque
-from typing import Dict
+from typing import Dict, FrozenSet, Optional, Tuple
 
 from src.config.settings import settings
 
 logger = logging.getLogger(__name__)
 
+UNAUTHORIZED_MSG = "⛔ Unauthorized access."
+RATE_LIMITED_MSG = "⏱️ Rate limit exceeded. Please wait."
+
 
 class RateLimiter:
-    """Simple in-memory rate limiter."""
+    """Simple in-memory rate limiter (token bucket per user).
+
+    Each user may burst up to ``limit`` requests, refilled at
+    ``limit / window`` requests per second.
+    """
+
+    __slots__ = ("buckets", "limit", "window", "rate")
 
     def __init__(self):
-        self.requests: Dict[int, deque] = defaultdict(deque)
+        # user_id -> (tokens, last refill timestamp)
+        self.buckets: Dict[int, Tuple[float, float]] = {}
         self.limit = settings.rate_limit_requests
         self.window = settings.rate_limit_window
+        self.rate = self.limit / self.window
 
     def is_allowed(self, user_id: int) -> bool:
         """Check if user is within rate limits."""
-        now = time.time()
-        user_requests = self.requests[user_id]
+        now = time.monotonic()
+        tokens, last = self.buckets.get(user_id, (self.limit, now))
+        tokens = min(self.limit, tokens + (now - last) * self.rate)
 
-        # Remove old requests outside the window
-        while user_requests and user_requests[0] < now - self.window:
-            user_requests.popleft()
-
-        # Check if under limit
-        if len(user_requests) < self.limit:
-            user_requests.append(now)
+        if tokens >= 1:
+            self.buckets[user_id] = (tokens - 1, now)
             return True
 
+        self.buckets[user_id] = (tokens, now)
         return False
 
 
 class SecurityValidator:
     """Validates user access and permissions."""
 
+    __slots__ = ("rate_limiter", "allowed_users")
+
     def __init__(self):
         self.rate_limiter = RateLimiter()
-        self.allowed_users = settings.allowed_users
+        # Settings already parse the IDs as ints; freeze them for hash lookups
+        self.allowed_users: FrozenSet[int] = frozenset(settings.allowed_users)
 
     def is_authorized(self, user_id: int) -> bool:
         """Check if user is authorized."""
@@ -49,6 +59,14 @@ class SecurityValidator:
         """Check if user is within rate limits."""
         return self.rate_limiter.is_allowed(user_id)
 
+    def precheck(self, user_id: int) -> Optional[str]:
+        """Run all per-request checks; return the rejection message or None."""
+        if user_id not in self.allowed_users:
+            return UNAUTHORIZED_MSG
+        if not self.rate_limiter.is_allowed(user_id):
+            return RATE_LIMITED_MSG
+        return None
+
 
 # Global validator instance
 security_validator = SecurityValidator()
@@ -0,0 +1,381 @@
+"""
+Render file edit diffs as PNG images for Telegram previews.
+Produces a unified diff colored like a dark-theme code review view.
+"""
+import asyncio
+import difflib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import groupby, islice
+from typing import Optional
+
+from PIL import Image, ImageDraw, ImageFont
+
+# Layout
+MAX_LINES = 100
+MAX_WIDTH = 800
+FONT_SIZE = 14
+LINE_HEIGHT = 20
+PADDING = 20
+LINE_NUM_WIDTH = 50
+
+# Previews are short-lived: favor encode speed over file size
+PNG_COMPRESS_LEVEL = 1
+# Palette size for encoding: the 7 theme colors plus antialiased text edges
+PALETTE_COLORS = 64
+
+# Colors (dark theme)
+BG_COLOR = "#0d1117"
+ADDED_BG_COLOR = "#12261e"
+REMOVED_BG_COLOR = "#25171c"
+ADDED_TEXT_COLOR = "#3fb950"
+REMOVED_TEXT_COLOR = "#f85149"
+TEXT_COLOR = "#c9d1d9"
+LINE_NUM_COLOR = "#6e7681"
+
+# Rendering is CPU-bound; a small process pool keeps it off the event loop
+# (each worker holds its own Pillow, font and line-number strip)
+POOL_WORKERS = min(2, os.cpu_count() or 1)
+_pool: Optional[ProcessPoolExecutor] = None
+
+FONT_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
+    "DejaVuSansMono.ttf",
+]
+
+
+def hex_to_rgb(hex_color: str) -> tuple:
+    """Convert '#rrggbb' to an (r, g, b) tuple."""
+    hex_color = hex_color.lstrip("#")
+    return (
+        int(hex_color[0:2], 16),
+        int(hex_color[2:4], 16),
+        int(hex_color[4:6], 16),
+    )
+
+
+# Palette as RGB tuples, parsed once
+BG_RGB = hex_to_rgb(BG_COLOR)
+ADDED_BG_RGB = hex_to_rgb(ADDED_BG_COLOR)
+REMOVED_BG_RGB = hex_to_rgb(REMOVED_BG_COLOR)
+ADDED_TEXT_RGB = hex_to_rgb(ADDED_TEXT_COLOR)
+REMOVED_TEXT_RGB = hex_to_rgb(REMOVED_TEXT_COLOR)
+TEXT_RGB = hex_to_rgb(TEXT_COLOR)
+LINE_NUM_RGB = hex_to_rgb(LINE_NUM_COLOR)
+
+# Line types without a line number
+_UNNUMBERED = frozenset({"header", "hunk", "truncated"})
+
+# Diff line type -> (background, text) colors
+_LINE_COLORS = {
+    "header": (BG_RGB, LINE_NUM_RGB),
+    "added": (ADDED_BG_RGB, ADDED_TEXT_RGB),
+    "removed": (REMOVED_BG_RGB, REMOVED_TEXT_RGB),
+    "hunk": (BG_RGB, LINE_NUM_RGB),
+    "unchanged": (BG_RGB, TEXT_RGB),
+    "truncated": (BG_RGB, TEXT_RGB),
+}
+
+
+@lru_cache(maxsize=None)
+def _load_font(size: int):
+    """Load a monospace font, falling back to Pillow's default font.
+
+    Cached per size: each worker process resolves and parses the font once.
+    """
+    for path in FONT_PATHS:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=None)
+def _max_chars(size: int) -> int:
+    """Number of monospace characters that fit in the content column."""
+    char_width = _load_font(size).getlength("M")
+    return int((MAX_WIDTH - PADDING - LINE_NUM_WIDTH) / char_width)
+
+
+def _multiline_spacing(draw: ImageDraw.ImageDraw, font) -> int:
+    """Spacing that makes Pillow's multiline text advance exactly LINE_HEIGHT."""
+    return LINE_HEIGHT - draw.textbbox((0, 0), "A", font=font)[3]
+
+
+@lru_cache(maxsize=1)
+def _line_number_strip() -> Image.Image:
+    """Mask with the line numbers 1..MAX_LINES, one per row (built once)."""
+    font = _load_font(FONT_SIZE)
+    strip = Image.new("L", (LINE_NUM_WIDTH, MAX_LINES * LINE_HEIGHT), 0)
+    draw = ImageDraw.Draw(strip)
+    draw.multiline_text(
+        (0, 2),
+        "\n".join(f"{i:4d}" for i in range(1, MAX_LINES + 1)),
+        font=font,
+        fill=255,
+        spacing=_multiline_spacing(draw, font),
+    )
+    return strip
+
+
+def _get_line_type(line: str) -> str:
+    """Classify a unified diff body line by its first character."""
+    first = line[:1]
+    if first == "+":
+        return "added"
+    if first == "-":
+        return "removed"
+    if first == "@" and line.startswith("@@"):
+        return "hunk"
+    return "unchanged"
+
+
+def _line_types(diff_lines) -> list:
+    """Classify the lines of a diff from _unified_diff.
+
+    The file headers are always its first two lines; going by position
+    keeps a removed "-- comment" or an added "++i;" from looking like one.
+    """
+    return ["header"] * 2 + [_get_line_type(line) for line in diff_lines[2:]]
+
+
+def _encode_png(img: Image.Image) -> bytes:
+    """Encode an image as 8-bit palette PNG bytes.
+
+    Drawing stays in RGB so text keeps its antialiasing (Pillow draws
+    aliased text on 'P' images); the few colors then fit in a palette.
+    """
+    img = img.quantize(colors=PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def _format_range(start: int, stop: int) -> str:
+    """Format a hunk range like difflib's unified diff ("start,length")."""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return str(beginning)
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def _diff_opcodes(old_ids, new_ids):
+    """SequenceMatcher opcodes, run only between the common prefix and suffix."""
+    limit = min(len(old_ids), len(new_ids))
+    head = 0
+    while head < limit and old_ids[head] == new_ids[head]:
+        head += 1
+    tail = 0
+    while tail < limit - head and old_ids[-1 - tail] == new_ids[-1 - tail]:
+        tail += 1
+    old_end = len(old_ids) - tail
+    new_end = len(new_ids) - tail
+
+    codes = [("equal", 0, head, 0, head)] if head else []
+    matcher = difflib.SequenceMatcher(
+        None, old_ids[head:old_end], new_ids[head:new_end]
+    )
+    # The trimmed middle starts and ends with a change, so nothing to merge
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        codes.append((tag, i1 + head, i2 + head, j1 + head, j2 + head))
+    if tail:
+        codes.append(("equal", old_end, len(old_ids), new_end, len(new_ids)))
+    return codes
+
+
+def _group_opcodes(codes, context: int):
+    """Split opcodes into hunks with ``context`` equal lines around changes.
+
+    Same grouping as SequenceMatcher.get_grouped_opcodes.
+    """
+    if not codes:
+        return
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # Long unchanged runs end one hunk and start the next
+        if tag == "equal" and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _unified_diff(old_lines, new_lines, filename: str, context: int = 3):
+    """Yield unified diff lines, like difflib.unified_diff with lineterm="".
+
+    Lines are matched as interned integer ids, and SequenceMatcher only
+    runs on the region between the common prefix and suffix, so a small
+    edit in a large file costs about as much as the edit itself.
+    """
+    ids = {}
+    old_ids = [ids.setdefault(line, len(ids)) for line in old_lines]
+    new_ids = [ids.setdefault(line, len(ids)) for line in new_lines]
+
+    started = False
+    for group in _group_opcodes(_diff_opcodes(old_ids, new_ids), context):
+        if not started:
+            started = True
+            yield f"--- a/{filename}"
+            yield f"+++ b/{filename}"
+
+        first, last = group[0], group[-1]
+        old_range = _format_range(first[1], last[2])
+        new_range = _format_range(first[3], last[4])
+        yield f"@@ -{old_range} +{new_range} @@"
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in old_lines[i1:i2]:
+                    yield " " + line
+                continue
+            if tag in ("replace", "delete"):
+                for line in old_lines[i1:i2]:
+                    yield "-" + line
+            if tag in ("replace", "insert"):
+                for line in new_lines[j1:j2]:
+                    yield "+" + line
+
+
+def generate_diff_image(old_content: str, new_content: str, filename: str) -> bytes:
+    """Render the unified diff between two file versions as PNG bytes."""
+    if (old_content or "") == (new_content or ""):
+        return _create_no_changes_image()
+
+    diff_iter = _unified_diff(
+        (old_content or "").splitlines(), (new_content or "").splitlines(), filename
+    )
+    # Only the visible lines are kept; the rest is counted, not stored
+    diff_lines = list(islice(diff_iter, MAX_LINES))
+
+    if not diff_lines:
+        return _create_no_changes_image()
+
+    # Truncate very long diffs
+    remaining = sum(1 for _ in diff_iter)
+    if remaining:
+        diff_lines.append(f"... ({remaining} more lines truncated)")
+
+    font = _load_font(FONT_SIZE)
+
+    num_lines = len(diff_lines)
+    img_height = PADDING * 2 + num_lines * LINE_HEIGHT
+    img = Image.new("RGB", (MAX_WIDTH, img_height), BG_RGB)
+    draw = ImageDraw.Draw(img)
+    line_types = _line_types(diff_lines)
+    if remaining:
+        line_types[-1] = "truncated"
+    line_colors = [_LINE_COLORS[line_type] for line_type in line_types]
+
+    # Line backgrounds: one fill per run of consecutive same-colored lines
+    row = 0
+    for bg_color, run in groupby(bg for bg, _ in line_colors):
+        count = sum(1 for _ in run)
+        if bg_color != BG_RGB:
+            y = PADDING + row * LINE_HEIGHT
+            draw.rectangle([0, y, MAX_WIDTH, y + count * LINE_HEIGHT], fill=bg_color)
+        row += count
+
+    # Line numbers: runs of rows from the prerendered strip, counting only
+    # diff lines; file headers, hunk markers and the truncation notice are
+    # left unnumbered
+    strip = _line_number_strip()
+    numbers = Image.new("L", (LINE_NUM_WIDTH, num_lines * LINE_HEIGHT), 0)
+    row = numbered = 0
+    for is_marker, run in groupby(t in _UNNUMBERED for t in line_types):
+        count = sum(1 for _ in run)
+        if not is_marker:
+            top = numbered * LINE_HEIGHT
+            rows = strip.crop((0, top, LINE_NUM_WIDTH, top + count * LINE_HEIGHT))
+            numbers.paste(rows, (0, row * LINE_HEIGHT))
+            numbered += count
+        row += count
+    img.paste(LINE_NUM_RGB, (PADDING, PADDING), mask=numbers)
+
+    # Content: one multiline draw per text color, with blank rows where a
+    # line belongs to another color
+    spacing = _multiline_spacing(draw, font)
+
+    # Cut lines at the image edge rather than drawing text off-canvas
+    max_chars = _max_chars(FONT_SIZE)
+    display_lines = [
+        line if len(line) <= max_chars else line[: max_chars - 3] + "..."
+        for line in diff_lines
+    ]
+    for text_color in {text for _, text in line_colors}:
+        draw.multiline_text(
+            (PADDING + LINE_NUM_WIDTH, PADDING + 2),
+            "\n".join(
+                text if color == text_color else ""
+                for text, (_, color) in zip(display_lines, line_colors)
+            ),
+            font=font,
+            fill=text_color,
+            spacing=spacing,
+        )
+
+    return _encode_png(img)
+
+
+async def generate_diff_image_async(
+    old_content: str, new_content: str, filename: str
+) -> bytes:
+    """Render the diff PNG in the worker pool without blocking the event loop.
+
+    A pool broken by a dead worker (e.g. OOM-killed) is replaced and the
+    render retried once.
+    """
+    global _pool
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS)
+        try:
+            return await loop.run_in_executor(
+                _pool, generate_diff_image, old_content, new_content, filename
+            )
+        except BrokenProcessPool:
+            shutdown_pool()
+            if attempt:
+                raise
+
+
+def shutdown_pool() -> None:
+    """Stop the render workers, if they were started."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+@lru_cache(maxsize=1)
+def _create_no_changes_image() -> bytes:
+    """Render a small placeholder image for edits without changes (once)."""
+    font = _load_font(FONT_SIZE)
+
+    img = Image.new("RGB", (400, 100), BG_RGB)
+    draw = ImageDraw.Draw(img)
+    draw.text(
+        (PADDING, 40),
+        "No changes",
+        font=font,
+        fill=TEXT_RGB,
+    )
+
+    return _encode_png(img)
@@ -0,0 +1,41 @@
+"""Async token-bucket rate limiting for outgoing Telegram API calls."""
+import asyncio
+import time
+
+
+class AsyncTokenBucket:
+    """Token bucket refilled at ``rate`` tokens/second, holding up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        """Add the tokens earned since the last update."""
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available, without waiting."""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def defer(self, seconds: float) -> None:
+        """Hand out no tokens for the next ``seconds`` (e.g. after a 429)."""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    async def acquire(self) -> None:
+        """Wait until a token is available, then take it."""
+        async with self._lock:
+            while not self.try_acquire():
+                await asyncio.sleep((1 - self._tokens) / self.rate)
@@ -0,0 +1,58 @@
+"""Shared test setup: bot settings from the environment, a fake claude CLI
+and a manual clock."""
+import os
+import sys
+import tempfile
+import textwrap
+
+import pytest
+
+# src.config.settings reads these at import time
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test-token")
+os.environ.setdefault("TELEGRAM_BOT_USERNAME", "test_bot")
+os.environ.setdefault("APPROVED_DIRECTORY", tempfile.gettempdir())
+os.environ.setdefault("ALLOWED_USERS", "[42]")
+
+
+@pytest.fixture
+def fake_claude(tmp_path, monkeypatch):
+    """Install a ``claude`` executable on PATH that runs the given script.
+
+    The script is Python; it sees the CLI arguments in ``sys.argv``.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+
+    def install(script: str):
+        path = bin_dir / "claude"
+        path.write_text(f"#!{sys.executable}\n" + textwrap.dedent(script))
+        path.chmod(0o755)
+        return path
+
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return install
+
+
+class FakeClock:
+    """Stand-in for the time module whose monotonic clock only moves on demand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """Replace the ``time`` module of the given module with a FakeClock.
+
+    Tests advance time by adding to the returned clock's ``now``.
+    """
+
+    def install(module) -> FakeClock:
+        clock = FakeClock()
+        monkeypatch.setattr(module, "time", clock)
+        return clock
+
+    return install
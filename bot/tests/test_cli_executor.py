@@ -0,0 +1,188 @@
+"""Tests for the Claude CLI executor, run against a fake claude CLI."""
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from src.claude.cli_executor import ClaudeProcessManager, per_update_callback
+
+PRELUDE = """
+import json, os, sys, time
+
+def emit(msg):
+    sys.stdout.write(json.dumps(msg) + "\\n")
+    sys.stdout.flush()
+
+def text(t):
+    return {"type": "assistant", "message": {"content": [{"type": "text", "text": t}]}}
+
+def tool(name):
+    block = {"type": "tool_use", "id": "t", "name": name, "input": {}}
+    return {"type": "assistant", "message": {"content": [block]}}
+
+RESULT = {"type": "result", "session_id": "s-1", "total_cost_usd": 0.25}
+"""
+
+
+def make_manager(timeout=30, batch_interval=0.05):
+    manager = ClaudeProcessManager(
+        SimpleNamespace(
+            claude_timeout_seconds=timeout,
+            claude_max_turns=3,
+            claude_allowed_tools=(),
+        )
+    )
+    manager.stream_batch_interval = batch_interval
+    return manager
+
+
+async def run(manager, tmp_path, **kwargs):
+    """Execute a prompt, returning the response and the update batches."""
+    batches = []
+
+    async def callback(updates):
+        batches.append([(u.type, u.content) for u in updates])
+
+    response = await manager.execute_command(
+        "hi", tmp_path, stream_callback=callback, **kwargs
+    )
+    return response, batches
+
+
+@pytest.mark.asyncio
+async def test_batches_are_capped_by_count(fake_claude, tmp_path):
+    fake_claude(PRELUDE + "for i in range(20): emit(text(str(i)))\nemit(RESULT)\n")
+    manager = make_manager(batch_interval=10)
+
+    response, batches = await run(manager, tmp_path)
+
+    assert [len(batch) for batch in batches] == [8, 8, 5]
+    contents = [content for batch in batches for _, content in batch]
+    assert contents == [str(i) for i in range(20)] + ["✅ Execution completed"]
+    assert response.content == "\n".join(str(i) for i in range(20))
+    assert response.session_id == "s-1"
+    assert response.cost == 0.25
+
+
+@pytest.mark.asyncio
+async def test_batch_is_flushed_at_its_deadline(fake_claude, tmp_path):
+    fake_claude(PRELUDE + "emit(text('a'))\ntime.sleep(0.5)\nemit(RESULT)\n")
+
+    _, batches = await run(make_manager(batch_interval=0.05), tmp_path)
+
+    # The text went out on its own while the CLI was quiet
+    assert batches == [
+        [("assistant", "a")],
+        [("result", "✅ Execution completed")],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_tool_use_and_result_flush_immediately(fake_claude, tmp_path):
+    fake_claude(
+        PRELUDE
+        + "emit(text('a'))\nemit(tool('Read'))\ntime.sleep(0.3)\n"
+        + "emit(text('b'))\nemit(RESULT)\n"
+    )
+
+    response, batches = await run(make_manager(batch_interval=10), tmp_path)
+
+    assert batches == [
+        [("assistant", "a"), ("tool_use", "🔧 Read")],
+        [("assistant", "b"), ("result", "✅ Execution completed")],
+    ]
+    assert [tool["name"] for tool in response.tools_used] == ["Read"]
+
+
+@pytest.mark.asyncio
+async def test_partial_line_survives_a_batch_timeout(fake_claude, tmp_path):
+    fake_claude(
+        PRELUDE
+        + """
+emit(text("a"))
+line = json.dumps(text("b")) + "\\n"
+sys.stdout.write(line[:10])
+sys.stdout.flush()
+time.sleep(0.3)
+sys.stdout.write(line[10:])
+emit(RESULT)
+"""
+    )
+
+    response, batches = await run(make_manager(batch_interval=0.05), tmp_path)
+
+    assert batches == [
+        [("assistant", "a")],
+        [("assistant", "b"), ("result", "✅ Execution completed")],
+    ]
+    assert response.content == "a\nb"
+
+
+@pytest.mark.asyncio
+async def test_per_update_callback_sees_every_update(fake_claude, tmp_path):
+    fake_claude(PRELUDE + "for i in range(10): emit(text(str(i)))\nemit(RESULT)\n")
+    seen = []
+
+    async def callback(update):
+        seen.append(update.content)
+
+    await make_manager().execute_command(
+        "hi", tmp_path, stream_callback=per_update_callback(callback)
+    )
+
+    assert seen == [str(i) for i in range(10)] + ["✅ Execution completed"]
+
+
+@pytest.mark.asyncio
+async def test_timeout_kills_the_cli(fake_claude, tmp_path):
+    pid_file = tmp_path / "pid"
+    fake_claude(
+        PRELUDE
+        + f"open({str(pid_file)!r}, 'w').write(str(os.getpid()))\n"
+        + "emit(text('a'))\ntime.sleep(30)\n"
+    )
+    manager = make_manager(timeout=0.5)
+
+    with pytest.raises(TimeoutError):
+        await run(manager, tmp_path)
+
+    assert manager.active_processes == {}
+    # Killed and reaped: the PID no longer exists
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+@pytest.mark.asyncio
+async def test_failure_with_large_stderr(fake_claude, tmp_path):
+    # Far more stderr than a pipe holds: the CLI must not block writing it
+    fake_claude(
+        PRELUDE
+        + "emit(text('a'))\n"
+        + "sys.stderr.write('x' * (2 * 1024 * 1024) + 'the real error')\n"
+        + "sys.exit(3)\n"
+    )
+    manager = make_manager()
+
+    response, _ = await run(manager, tmp_path)
+
+    assert response.is_error
+    assert response.error_type == "process_error"
+    assert response.session_id == ""
+    assert response.content.endswith("the real error")
+    assert len(response.content) <= len("Error: ...") + manager.max_error_chars
+
+
+@pytest.mark.asyncio
+async def test_unknown_session_is_reported(fake_claude, tmp_path):
+    fake_claude(
+        PRELUDE
+        + "sys.stderr.write('No conversation found with session ID: s-0\\n')\n"
+        + "sys.exit(1)\n"
+    )
+
+    response, _ = await run(
+        make_manager(), tmp_path, session_id="s-0", continue_session=True
+    )
+
+    assert response.is_error
+    assert response.error_type == "session_not_found"
@@ -0,0 +1,168 @@
+"""Tests for the unified diff behind the diff preview images."""
+import asyncio
+import difflib
+import io
+import os
+import random
+import re
+import signal
+
+import pytest
+from PIL import Image
+
+from src.utils import diff_image
+from src.utils.diff_image import _line_types, _unified_diff, generate_diff_image
+
+HUNK_RE = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def apply_diff(old_lines, diff):
+    """Apply unified diff hunks to old_lines, checking context and headers."""
+    assert diff[:2] == ["--- a/f", "+++ b/f"]
+    result, pos = [], 0
+    body = diff[2:]
+    i = 0
+    while i < len(body):
+        match = HUNK_RE.fullmatch(body[i])
+        assert match, body[i]
+        old_start, old_len, new_start, new_len = (
+            int(group) if group is not None else 1 for group in match.groups()
+        )
+        # An empty range names the line *after* which the hunk goes
+        start = old_start - 1 if old_len else old_start
+        assert start >= pos
+        result += old_lines[pos:start]
+        pos = start
+        assert new_start - (1 if new_len else 0) == len(result)
+        i += 1
+        removed = added = 0
+        while i < len(body) and not body[i].startswith("@@"):
+            tag, text = body[i][0], body[i][1:]
+            if tag in " -":
+                assert old_lines[pos] == text
+                pos += 1
+                removed += 1
+            if tag in " +":
+                result.append(text)
+                added += 1
+            i += 1
+        assert (removed, added) == (old_len, new_len)
+    return result + old_lines[pos:]
+
+
+def diff(old_lines, new_lines, context=3):
+    return list(_unified_diff(old_lines, new_lines, "f", context))
+
+
+@pytest.mark.parametrize(
+    "old, new",
+    [
+        ([], ["a"]),
+        (["a"], []),
+        (["a", "b"], ["a", "b", "c"]),  # suffix-only change
+        (["b", "c"], ["a", "b", "c"]),  # prefix-only change
+        (["a", "x", "c"], ["a", "y", "c"]),
+        (list("abcdefghijklmnop"), list("abcdXfghijklmnoY")),  # two hunks
+    ],
+)
+def test_hunks_reproduce_new_text(old, new):
+    result = diff(old, new)
+    assert apply_diff(old, result) == new
+    assert result == list(difflib.unified_diff(old, new, "a/f", "b/f", lineterm=""))
+
+
+def test_no_output_without_changes():
+    assert diff([], []) == []
+    assert diff(["a", "b"], ["a", "b"]) == []
+    # Differs only in the trailing newline, which splitlines() drops
+    assert diff("a\n".splitlines(), "a".splitlines()) == []
+
+
+def test_random_edits_apply_cleanly():
+    rng = random.Random(3)
+    for _ in range(2000):
+        old = [rng.choice("abcde") for _ in range(rng.randrange(40))]
+        new = list(old)
+        for _ in range(rng.randrange(5)):
+            op = rng.randrange(3)
+            if op == 0 and new:
+                new[rng.randrange(len(new))] = rng.choice("abcdef")
+            elif op == 1:
+                new.insert(rng.randrange(len(new) + 1), rng.choice("abcdef"))
+            elif new:
+                del new[rng.randrange(len(new))]
+        context = rng.randrange(4)
+        result = diff(old, new, context)
+        # Trimming may pick a different, equally valid alignment than difflib
+        assert bool(result) == (old != new)
+        if result:
+            assert apply_diff(old, result) == new
+
+
+@pytest.mark.parametrize(
+    "old, new", [("a\n", "a\nb\n"), ("", "new\n"), ("a\n", "a"), ("same", "same")]
+)
+def test_generate_diff_image_returns_png(old, new):
+    assert generate_diff_image(old, new, "f.py").startswith(b"\x89PNG\r\n\x1a\n")
+
+
+def test_headers_are_classified_by_position():
+    diff = list(
+        _unified_diff(["-- old comment", "i++;"], ["-- new comment", "++i;"], "f")
+    )
+
+    assert diff[2:] == [
+        "@@ -1,2 +1,2 @@",
+        "--- old comment",
+        "-i++;",
+        "+-- new comment",
+        "+++i;",
+    ]
+    assert _line_types(diff) == [
+        "header",
+        "header",
+        "hunk",
+        "removed",
+        "removed",
+        "added",
+        "added",
+    ]
+
+
+def test_truncation_notice_is_unnumbered():
+    old = "\n".join(f"line {i}" for i in range(300))
+    image = Image.open(io.BytesIO(generate_diff_image(old, "", "f"))).convert("RGB")
+
+    # Gutter of the last row, which holds the notice (below the one pixel
+    # the previous row's background reaches into)
+    top = image.height - diff_image.PADDING - diff_image.LINE_HEIGHT + 1
+    gutter = image.crop(
+        (
+            diff_image.PADDING,
+            top,
+            diff_image.PADDING + diff_image.LINE_NUM_WIDTH,
+            top + diff_image.LINE_HEIGHT,
+        )
+    )
+    assert gutter.getcolors() == [(gutter.width * gutter.height, diff_image.BG_RGB)]
+
+
+@pytest.mark.asyncio
+async def test_render_pool_recovers_from_a_dead_worker():
+    try:
+        await diff_image.generate_diff_image_async("a", "b", "f")
+        pool = diff_image._pool
+        for pid in list(pool._processes):
+            os.kill(pid, signal.SIGKILL)
+        # Let the pool notice its dead worker
+        for _ in range(50):
+            if pool._broken:
+                break
+            await asyncio.sleep(0.1)
+
+        image = await diff_image.generate_diff_image_async("a", "c", "f")
+
+        assert image.startswith(b"\x89PNG")
+        assert diff_image._pool is not pool
+    finally:
+        diff_image.shutdown_pool()
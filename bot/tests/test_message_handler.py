@@ -0,0 +1,200 @@
+"""Tests for the Telegram message handler, run against a fake claude CLI."""
+import asyncio
+from collections import defaultdict
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from src.handlers import message_handler
+from src.utils.rate_limiter import AsyncTokenBucket
+
+USER_ID = 42  # In ALLOWED_USERS (see conftest.py)
+
+# Emits one Edit tool call; append the rest of the run
+EDIT_CALL = """
+import json, sys, time
+
+edit = {
+    "type": "tool_use",
+    "id": "toolu_1",
+    "name": "Edit",
+    "input": {
+        "file_path": "app.py",
+        "old_string": "x = 1\\n",
+        "new_string": "x = 2\\n",
+    },
+}
+print(json.dumps({"type": "assistant", "message": {"content": [edit]}}), flush=True)
+"""
+
+EDIT_SCRIPT = (
+    EDIT_CALL
+    + """
+print(json.dumps({
+    "type": "assistant",
+    "message": {"content": [{"type": "text", "text": "Done."}]},
+}))
+print(json.dumps({"type": "result", "session_id": "s-1", "total_cost_usd": 0.01}))
+"""
+)
+
+
+@pytest.fixture(autouse=True)
+def fast_send_budget(monkeypatch):
+    """Let tests send as fast as they like, each with a fresh request budget."""
+    monkeypatch.setattr(
+        message_handler,
+        "_chat_buckets",
+        defaultdict(lambda: AsyncTokenBucket(rate=1000, capacity=1000)),
+    )
+    monkeypatch.setattr(message_handler.security_validator.rate_limiter, "buckets", {})
+    yield
+    message_handler.shutdown_diff_pool()
+    message_handler._executor.cache_clear()
+
+
+def make_update(text):
+    """Build a fake Update whose replies are recorded."""
+    thinking_msg = MagicMock()
+    thinking_msg.edit_text = AsyncMock()
+
+    update = MagicMock()
+    update.effective_user.id = USER_ID
+    update.effective_chat.id = USER_ID
+    update.message.text = text
+    update.message.reply_text = AsyncMock(return_value=thinking_msg)
+    update.message.reply_photo = AsyncMock()
+    return update, thinking_msg
+
+
+def make_context(user_data=None):
+    """Build a fake callback context with the given user_data."""
+    context = MagicMock()
+    context.user_data = {} if user_data is None else user_data
+    context.bot.send_chat_action = AsyncMock()
+    return context
+
+
+@pytest.mark.asyncio
+async def test_edit_tool_call_sends_diff_preview(fake_claude):
+    fake_claude(EDIT_SCRIPT)
+    update, thinking_msg = make_update("bump x")
+    context = make_context()
+
+    await message_handler.handle_message(update, context)
+
+    update.message.reply_photo.assert_awaited_once()
+    kwargs = update.message.reply_photo.await_args.kwargs
+    assert kwargs["photo"].startswith(b"\x89PNG")
+    assert "app.py" in kwargs["caption"]
+    thinking_msg.edit_text.assert_awaited_with("Done.")
+    assert context.user_data["claude_session_id"] == "s-1"
+
+
+@pytest.mark.asyncio
+async def test_failed_resume_drops_stored_session(fake_claude, tmp_path):
+    argv_log = tmp_path / "argv.log"
+    fake_claude(
+        f"""
+        import json, sys
+
+        with open({str(argv_log)!r}, "a") as log:
+            log.write(json.dumps(sys.argv[1:]) + "\\n")
+        if "--resume" in sys.argv:
+            sys.stderr.write("No conversation found with session ID\\n")
+            sys.exit(1)
+        print(json.dumps({{"type": "result", "session_id": "s-new"}}))
+        """
+    )
+    context = make_context({"claude_session_id": "s-stale"})
+
+    update, thinking_msg = make_update("hello")
+    await message_handler.handle_message(update, context)
+    assert "No conversation found" in thinking_msg.edit_text.await_args.args[0]
+    assert "claude_session_id" not in context.user_data
+
+    # The next message starts a fresh session instead of failing again
+    update, _ = make_update("hello again")
+    await message_handler.handle_message(update, context)
+    assert context.user_data["claude_session_id"] == "s-new"
+
+    first, second = argv_log.read_text().splitlines()
+    assert '"--resume", "s-stale"' in first
+    assert "--resume" not in second
+
+
+@pytest.mark.asyncio
+async def test_other_failure_keeps_stored_session(fake_claude):
+    fake_claude(
+        """
+        import sys
+
+        sys.stderr.write("API Error: 529 Overloaded\\n")
+        sys.exit(1)
+        """
+    )
+    context = make_context({"claude_session_id": "s-1"})
+
+    update, thinking_msg = make_update("hello")
+    await message_handler.handle_message(update, context)
+
+    assert "Overloaded" in thinking_msg.edit_text.await_args.args[0]
+    assert context.user_data["claude_session_id"] == "s-1"
+
+
+@pytest.mark.parametrize(
+    "ending, reply",
+    [("sys.exit(1)", "Error: "), ("time.sleep(30)", "timed out")],
+)
+@pytest.mark.asyncio
+async def test_failed_run_sends_no_diff_preview(
+    fake_claude, monkeypatch, ending, reply
+):
+    fake_claude(EDIT_CALL + ending)
+    message_handler._executor().timeout_seconds = 1
+    # Hold rendering until the handler is done with the failed run
+    rendered = asyncio.Event()
+
+    async def render_diff(*args):
+        await rendered.wait()
+        return b"\x89PNG"
+
+    monkeypatch.setattr(message_handler, "_render_diff", render_diff)
+    update, thinking_msg = make_update("bump x")
+
+    await asyncio.wait_for(
+        message_handler.handle_message(update, make_context()), timeout=10
+    )
+    rendered.set()
+    await asyncio.sleep(0.1)
+
+    replies = [call.args[0] for call in thinking_msg.edit_text.await_args_list]
+    replies += [call.args[0] for call in update.message.reply_text.await_args_list]
+    assert any(reply in text for text in replies)
+    update.message.reply_photo.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_welcome_waits_for_the_chat_budget(monkeypatch):
+    bucket = MagicMock()
+    bucket.acquire = AsyncMock()
+    monkeypatch.setattr(message_handler, "_chat_buckets", {USER_ID: bucket})
+    update, _ = make_update("/start")
+
+    await message_handler.start_command(update, make_context())
+
+    bucket.acquire.assert_awaited_once()
+    update.message.reply_text.assert_awaited_once()
+    assert update.message.reply_text.await_args.args[0].startswith("🤖 Claude Code Bot")
+
+
+@pytest.mark.asyncio
+async def test_typing_is_skipped_without_global_budget(monkeypatch):
+    bucket = AsyncTokenBucket(rate=1, capacity=1)
+    monkeypatch.setattr(message_handler, "_GLOBAL_BUCKET", bucket)
+    context = make_context()
+
+    await message_handler._send_typing(context, USER_ID)
+    await message_handler._send_typing(context, USER_ID)
+
+    context.bot.send_chat_action.assert_awaited_once()
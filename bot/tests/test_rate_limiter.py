@@ -0,0 +1,65 @@
+"""Tests for the async token bucket that paces Telegram sends."""
+import asyncio
+
+import pytest
+
+from src.utils import rate_limiter
+from src.utils.rate_limiter import AsyncTokenBucket
+
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(rate_limiter)
+
+
+def test_bursts_up_to_capacity_then_refills(clock):
+    bucket = AsyncTokenBucket(rate=2, capacity=3)
+
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+    clock.now += 0.5  # One token at 2 tokens/s
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+    clock.now += 60  # Refill stops at capacity
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_defer_holds_tokens_back(clock):
+    bucket = AsyncTokenBucket(rate=1, capacity=5)
+
+    bucket.defer(3)
+
+    clock.now += 3
+    assert not bucket.try_acquire()
+    clock.now += 1
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_a_token():
+    bucket = AsyncTokenBucket(rate=20, capacity=1)
+    loop = asyncio.get_running_loop()
+
+    start = loop.time()
+    for _ in range(3):
+        await bucket.acquire()
+
+    # The first token is free, the next two take 1/20 s each
+    assert loop.time() - start >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_concurrent_acquires_are_served_one_token_each():
+    bucket = AsyncTokenBucket(rate=50, capacity=2)
+    order = []
+
+    async def take(i):
+        await bucket.acquire()
+        order.append(i)
+
+    await asyncio.gather(*(take(i) for i in range(5)))
+
+    assert sorted(order) == list(range(5))
+    assert not bucket.try_acquire()
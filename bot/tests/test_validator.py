@@ -0,0 +1,57 @@
+"""Tests for user authorization and per-user rate limiting."""
+import pytest
+
+from src.config.settings import settings
+from src.security import validator
+from src.security.validator import (
+    RATE_LIMITED_MSG,
+    UNAUTHORIZED_MSG,
+    RateLimiter,
+    SecurityValidator,
+)
+
+ALLOWED_USER = 42  # In ALLOWED_USERS (see conftest.py)
+OTHER_USER = 7
+
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(validator)
+
+
+def test_rate_limiter_allows_a_burst_then_refills(clock):
+    limiter = RateLimiter()
+    limit = settings.rate_limit_requests
+
+    assert all(limiter.is_allowed(ALLOWED_USER) for _ in range(limit))
+    assert not limiter.is_allowed(ALLOWED_USER)
+
+    # One request's worth of refill
+    clock.now += settings.rate_limit_window / limit
+    assert limiter.is_allowed(ALLOWED_USER)
+    assert not limiter.is_allowed(ALLOWED_USER)
+
+
+def test_rate_limiter_tracks_users_separately(clock):
+    limiter = RateLimiter()
+
+    for _ in range(settings.rate_limit_requests):
+        limiter.is_allowed(ALLOWED_USER)
+
+    assert not limiter.is_allowed(ALLOWED_USER)
+    assert limiter.is_allowed(OTHER_USER)
+
+
+def test_precheck_rejects_unknown_users_without_using_their_budget(clock):
+    security = SecurityValidator()
+
+    assert security.precheck(OTHER_USER) == UNAUTHORIZED_MSG
+    assert OTHER_USER not in security.rate_limiter.buckets
+
+
+def test_precheck_rate_limits_authorized_users(clock):
+    security = SecurityValidator()
+
+    for _ in range(settings.rate_limit_requests):
+        assert security.precheck(ALLOWED_USER) is None
+    assert security.precheck(ALLOWED_USER) == RATE_LIMITED_MSG